@@ -1,22 +1,60 @@
 #!/usr/bin/env python3
-from io import StringIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, fields
+from datetime import date, timedelta
+from io import BytesIO
+from boto3.s3.transfer import TransferConfig
+import json
+import shutil
+import numpy as np
 import pandas as pd
 import traceback
 import psycopg2
+from psycopg2.extras import execute_values
 import boto3
 import sys
 import os
 import re
 import uuid
+import zlib
 import logging
 
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:  # csv falls back to pandas, file_format='parquet' requires pyarrow
+    pa = pa_csv = pq = None
+
 S3_ACCEPTED_KWARGS = [
-    'ACL', 'Body', 'CacheControl ', 'ContentDisposition', 'ContentEncoding', 'ContentLanguage',
-    'ContentLength', 'ContentMD5', 'ContentType', 'Expires', 'GrantFullControl', 'GrantRead',
+    'ACL', 'CacheControl', 'ContentDisposition', 'ContentEncoding', 'ContentLanguage',
+    'ContentType', 'Expires', 'GrantFullControl', 'GrantRead',
     'GrantReadACP', 'GrantWriteACP', 'Metadata', 'ServerSideEncryption', 'StorageClass',
     'WebsiteRedirectLocation', 'SSECustomerAlgorithm', 'SSECustomerKey', 'SSECustomerKeyMD5',
     'SSEKMSKeyId', 'RequestPayer', 'Tagging'
-]  # Available parameters for service: https://boto3.readthedocs.io/en/latest/reference/services/s3.html#S3.Client.put_object
+]  # Available parameters for service: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/s3.html#boto3.s3.transfer.S3Transfer.ALLOWED_UPLOAD_ARGS
+
+FILE_FORMATS = ['csv', 'parquet']
+
+# number of rows encoded to csv at a time while streaming a dataframe to S3
+CSV_CHUNK_ROWS = 100000
+# multipart upload tuning, parts are uploaded in parallel once a file passes the threshold
+S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+S3_MULTIPART_CHUNKSIZE = 32 * 1024 * 1024
+S3_MAX_CONCURRENCY = 8
+# frames are split into roughly this much in-memory data per S3 file, so COPY
+# can load the files in parallel across slices
+S3_PART_BYTES = 64 * 1024 * 1024
+MAX_S3_PARTS = 16
+# upper bound on upload threads across all parts, each part uses max_concurrency of them
+MAX_S3_UPLOAD_THREADS = 32
+# rows per multi-row insert statement when small frames are inserted directly
+INSERT_PAGE_ROWS = 1000
+# rows fetched per round trip when reading query results
+FETCH_ROWS = 50000
+# gzip level for csv uploads, 1 keeps the cpu cost low and still shrinks csv several times
+GZIP_LEVEL = 1
 
 logging_config = {
     'logger_level': logging.INFO,
@@ -26,6 +64,17 @@ logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
 
+def _load_reserved_words():
+    with open(os.path.join(os.path.dirname(__file__), 'redshift_reserve_words.txt'), 'r') as f:
+        return frozenset(r.strip().lower() for r in f)
+
+
+_RRWORDS = _load_reserved_words()
+_MASK_KEY_RE = re.compile("(?<=access_key_id ')(.*)(?=')")
+_MASK_SECRET_RE = re.compile("(?<=secret_access_key ')(.*)(?=')")
+_INTERVAL_RE = re.compile(r"interval\s*'(\d+)'?\s*day")
+
+
 def set_log_level(level, mask_secrets=True):
     log_level_map = {
         'debug': logging.DEBUG,
@@ -41,65 +90,171 @@ def set_log_level(level, mask_secrets=True):
 
 def mask_aws_credentials(s):
     if logging_config['mask_secrets']:
-        import re
-        s = re.sub('(?<=access_key_id \')(.*)(?=\')', '*' * 8, s)
-        s = re.sub('(?<=secret_access_key \')(.*)(?=\')', '*' * 8, s)
+        s = _MASK_KEY_RE.sub('*' * 8, s)
+        s = _MASK_SECRET_RE.sub('*' * 8, s)
     return s
 
 
-def connect_to_redshift(dbname, host, user, port=5439, **kwargs):
-    global connect, cursor
-    connect = psycopg2.connect(dbname=dbname,
-                               host=host,
-                               port=port,
-                               user=user,
-                               **kwargs)
+@dataclass
+class RSContext:
+    """Redshift connection and S3 settings used by the functions in this module.
+
+    Every function takes an optional ctx and falls back to a module level default
+    context, which is what connect_to_redshift and connect_to_s3 fill in when
+    called without one. Separate contexts can load different tables concurrently.
+    """
+    connect: object = None
+    cursor: object = None
+    s3: object = None
+    bucket: str = None
+    subdir: str = ''
+    aws_key: str = None
+    aws_secret: str = None
+    aws_token: str = ''
+    aws_role: str = None
+
+
+_default_ctx = RSContext()
+
+
+def _get_ctx(ctx):
+    return _default_ctx if ctx is None else ctx
 
-    cursor = connect.cursor()
 
+def connect_to_redshift(dbname, host, user, port=5439, ctx=None, **kwargs):
+    ctx = _get_ctx(ctx)
+    ctx.connect = psycopg2.connect(dbname=dbname,
+                                   host=host,
+                                   port=port,
+                                   user=user,
+                                   **kwargs)
 
-def connect_to_s3(aws_access_key_id, aws_secret_access_key, bucket, subdirectory=None, aws_iam_role=None, **kwargs):
-    global s3, s3_bucket_var, s3_subdirectory_var, aws_1, aws_2, aws_token, aws_role
-    s3 = boto3.resource('s3',
-                        aws_access_key_id=aws_access_key_id,
-                        aws_secret_access_key=aws_secret_access_key,
-                        **kwargs)
-    s3_bucket_var = bucket
+    ctx.cursor = ctx.connect.cursor()
+    return ctx
+
+
+def connect_to_s3(aws_access_key_id, aws_secret_access_key, bucket, subdirectory=None, aws_iam_role=None,
+                  ctx=None, **kwargs):
+    ctx = _get_ctx(ctx)
+    ctx.s3 = boto3.resource('s3',
+                            aws_access_key_id=aws_access_key_id,
+                            aws_secret_access_key=aws_secret_access_key,
+                            **kwargs)
+    ctx.bucket = bucket
     if subdirectory is None:
-        s3_subdirectory_var = ''
+        ctx.subdir = ''
     else:
-        s3_subdirectory_var = subdirectory + '/'
-    aws_1 = aws_access_key_id
-    aws_2 = aws_secret_access_key
-    aws_role = aws_iam_role
+        ctx.subdir = subdirectory + '/'
+    ctx.aws_key = aws_access_key_id
+    ctx.aws_secret = aws_secret_access_key
+    ctx.aws_role = aws_iam_role
     if kwargs.get('aws_session_token'):
-        aws_token = kwargs.get('aws_session_token')
+        ctx.aws_token = kwargs.get('aws_session_token')
     else:
-        aws_token = ''
+        ctx.aws_token = ''
+    return ctx
 
 
-def redshift_to_pandas(sql_query, query_params=None):
-    # pass a sql query and return a pandas dataframe
-    cursor.execute(sql_query, query_params)
+def _fetch_columns(cursor, batch_rows):
+    """Fetch the rest of an executed query in batches, returns the column names
+    and a list of values per column so the frame is built column-major"""
+    batch = cursor.fetchmany(batch_rows)
+    # description is only filled in after the first fetch on a named cursor
     columns_list = [desc[0] for desc in cursor.description]
-    data = pd.DataFrame(cursor.fetchall(), columns=columns_list)
+    columns_data = [[] for _ in columns_list]
+    while batch:
+        for column_data, values in zip(columns_data, zip(*batch)):
+            column_data.extend(values)
+        batch = cursor.fetchmany(batch_rows)
+    return columns_list, columns_data
+
+
+def redshift_to_pandas(sql_query, query_params=None, itersize=FETCH_ROWS, ctx=None):
+    # pass a sql query and return a pandas dataframe
+    # itersize=None runs it on the plain cursor, as do autocommit connections
+    # where named cursors can't be used
+    ctx = _get_ctx(ctx)
+    if itersize is None or ctx.connect.autocommit:
+        ctx.cursor.execute(sql_query, query_params)
+        columns_list, columns_data = _fetch_columns(ctx.cursor, itersize or FETCH_ROWS)
+    else:
+        # a named (server side) cursor streams the result in batches instead of
+        # holding every row as a tuple on the client
+        with ctx.connect.cursor(name='pr_{0}'.format(uuid.uuid4().hex)) as stream_cursor:
+            stream_cursor.itersize = itersize
+            stream_cursor.execute(sql_query, query_params)
+            columns_list, columns_data = _fetch_columns(stream_cursor, itersize)
+    # keyed by position, query results can repeat column names
+    data = pd.DataFrame(dict(enumerate(columns_data)))
+    data.columns = columns_list
     return data
 
 
+# dtypes for redshift column types in an empty schema frame, anything else is object
+_RS_TO_NP = {
+    'smallint': 'int64',
+    'integer': 'int64',
+    'bigint': 'int64',
+    'real': 'float64',
+    'double precision': 'float64',
+    'boolean': 'bool',
+    'timestamp without time zone': 'datetime64[ns]'
+}
+
+
+# arrow type aliases for redshift numeric types, so parquet files match the
+# physical types columnar copy expects for the target columns
+_RS_TO_ARROW = {
+    'smallint': 'int16', 'int2': 'int16',
+    'integer': 'int32', 'int': 'int32', 'int4': 'int32',
+    'bigint': 'int64', 'int8': 'int64',
+    'real': 'float32', 'float4': 'float32',
+    'double precision': 'float64', 'float8': 'float64', 'float': 'float64',
+    'boolean': 'bool', 'bool': 'bool'
+}
+
+
+def _get_table_columns(redshift_table_name, ctx):
+    """Return (column name, redshift type) pairs of a table, in column order"""
+    # regclass resolves the name the way the planner does (search_path, temp tables)
+    ctx.cursor.execute("""
+        select attname, format_type(atttypid, atttypmod)
+        from pg_catalog.pg_attribute
+        where attrelid = %s::regclass and attnum > 0 and not attisdropped
+        order by attnum
+        """, (redshift_table_name,))
+    columns = ctx.cursor.fetchall()
+    if not columns:
+        raise ValueError('No columns found for table {0}'.format(redshift_table_name))
+    return columns
+
+
+def _table_columns_to_frame(columns):
+    return pd.DataFrame({column_name: pd.Series(dtype=_RS_TO_NP.get(data_type, 'object'))
+                         for column_name, data_type in columns})
+
+
+def get_table_schema(redshift_table_name, ctx=None):
+    """Return an empty dataframe with the columns and dtypes of a redshift table,
+    read from the catalog instead of querying the table itself
+
+    Arguments:
+        redshift_table_name str -- table name, optionally qualified by its schema
+    """
+    return _table_columns_to_frame(_get_table_columns(redshift_table_name, _get_ctx(ctx)))
+
+
+# column defaults keyed on dtype kind: object, str, int, bool, float
+_DEFAULTS = {'O': 'na', 'U': 'na', 'i': 0, 'b': False, 'f': 0.0}
+
+
 def get_defaults(input_type):
-    """Generates defaults for different types of dataframe's columns """
-    default_val = 0
-    if input_type == 'object':
-        default_val = 'na'
-    if input_type == 'str':
-        default_val = 'na'
-    if input_type == 'int':
-        default_val = 0
-    if input_type == 'bool':
-        default_val = False
-    if input_type == 'float':
-        default_val = 0.0
-    return default_val
+    """Generates defaults for different types of dataframe's columns,
+    input_type can be a dtype or a dtype name """
+    if isinstance(input_type, str):
+        input_type = pd.api.types.pandas_dtype(input_type)
+    kind = input_type.kind
+    return _DEFAULTS.get(kind, 0)
 
 
 def invalidate_to_schema(raw_df, schema_df=None):
@@ -107,20 +262,20 @@ def invalidate_to_schema(raw_df, schema_df=None):
     1. If  column_name doesn't exist in  schema_df- drop it;
     2. If some column name from schema_df is missing - add it, populated by  default values
     3. Set order of columns in raw_df the same as schema_df"""
-    if schema_df is None or len(schema_df.index) == 0:
+    if schema_df is None or len(schema_df.columns) == 0:
         # do nothing if there is no schema
         return raw_df
-    cols_to_drop = []
-    for raw_col_name in raw_df.columns:
-        if raw_col_name not in schema_df.columns:
-            cols_to_drop.append(raw_col_name)
-    raw_df = raw_df.drop(cols_to_drop, axis=1)
-
-    for schema_col_name in schema_df.columns:
-        if schema_col_name not in raw_df.columns:
-            raw_df[schema_col_name] = get_defaults(schema_df[schema_col_name].dtype)
-
-    raw_df = raw_df[schema_df.columns]
+    extra_cols = raw_df.columns.difference(schema_df.columns)
+    if not extra_cols.empty:
+        raw_df = raw_df.drop(columns=extra_cols)
+
+    fill = {col: get_defaults(schema_df[col].dtype)
+            for col in schema_df.columns.difference(raw_df.columns)}
+    # reindex drops nothing now, it adds the missing columns and sets the order
+    raw_df = raw_df.reindex(columns=schema_df.columns)
+    if fill:
+        # reindex adds float NaN columns, give the filled ones their schema dtype back
+        raw_df = raw_df.fillna(value=fill).astype({col: schema_df[col].dtype for col in fill})
 
     return raw_df
 
@@ -131,79 +286,330 @@ def validate_column_names(data_frame):
     Arguments:
         dataframe pd.data_frame -- data to validate
     """
-    rrwords = open(os.path.join(os.path.dirname(__file__),
-                                'redshift_reserve_words.txt'), 'r').readlines()
-    rrwords = [r.strip().lower() for r in rrwords]
-
-    data_frame.columns = [x.lower() for x in data_frame.columns]
-
-    for col in data_frame.columns:
-        try:
-            assert col not in rrwords
-        except AssertionError:
-            raise ValueError(
-                'DataFrame column name {0} is a reserve word in redshift'
-                .format(col))
-
-    # check for spaces in the column names
-    there_are_spaces = sum(
-        [re.search('\s', x) is not None for x in data_frame.columns]) > 0
-    # delimit them if there are
-    if there_are_spaces:
-        col_names_dict = {x: '"{0}"'.format(x) for x in data_frame.columns}
-        data_frame.rename(columns=col_names_dict, inplace=True)
+    not_strings = [col for col in data_frame.columns if not isinstance(col, str)]
+    if not_strings:
+        raise ValueError(
+            'DataFrame column names must be strings, got {0}'.format(not_strings))
+    data_frame.columns = data_frame.columns.str.lower()
+
+    reserved = _RRWORDS.intersection(data_frame.columns)
+    if reserved:
+        raise ValueError(
+            'DataFrame column name {0} is a reserve word in redshift'
+            .format(', '.join(sorted(reserved))))
+
+    # check for spaces in the column names and delimit them if there are
+    if data_frame.columns.str.contains(r'\s').any():
+        data_frame.columns = '"' + data_frame.columns + '"'
     return data_frame
 
 
-def df_to_s3(data_frame, csv_name, index, save_local, delimiter, verbose=True, **kwargs):
-    """Write a dataframe to S3
+def _to_column_major(data_frame):
+    """Return data_frame with every column contiguous in memory.
+
+    Frames built from 2d row-major arrays keep each column strided across rows,
+    which makes encoding walk memory column by column with a cache miss per cell.
+    """
+    # only numpy backed columns live in 2d blocks, to_numpy() on extension
+    # columns (tz datetimes, strings, categoricals) would copy them just to look
+    if all(data_frame.iloc[:, i].to_numpy().flags.c_contiguous
+           for i, dtype in enumerate(data_frame.dtypes) if isinstance(dtype, np.dtype)):
+        return data_frame
+    # pandas copies each block in C order, i.e. one contiguous run per column
+    return data_frame.copy()
+
+
+def _arrow_field_for_redshift(field, redshift_type=None):
+    # redshift reads microsecond timestamps, pandas holds nanoseconds
+    if pa.types.is_timestamp(field.type):
+        return field.with_type(pa.timestamp('us', tz=field.type.tz))
+    # columnar copy needs numbers in the physical type of the target column
+    arrow_alias = _RS_TO_ARROW.get((redshift_type or '').strip().lower())
+    if arrow_alias and (pa.types.is_integer(field.type) or pa.types.is_floating(field.type)
+                        or pa.types.is_boolean(field.type)):
+        return field.with_type(pa.type_for_alias(arrow_alias))
+    return field
+
+
+def _df_to_arrow_table(data_frame, index, schema=None, column_data_types=None):
+    # the index goes first, in the same position create_redshift_table gives it
+    if index:
+        data_frame = data_frame.reset_index()
+    table = pa.Table.from_pandas(data_frame, schema=schema, preserve_index=False)
+    redshift_types = list(column_data_types or [])
+    redshift_types += [None] * (len(table.schema) - len(redshift_types))
+    schema = pa.schema([_arrow_field_for_redshift(field, redshift_type)
+                        for field, redshift_type in zip(table.schema, redshift_types)])
+    return table.cast(schema, safe=False)
+
+
+def _write_parquet(table, where):
+    pq.write_table(table, where, compression='snappy')
+
+
+def _arrow_csv_schema(data_frame, index):
+    """Arrow schema to encode every chunk of data_frame with, or None when pyarrow
+    is missing or can't write the frame as csv (e.g. object columns holding mixed
+    types, lists or dicts, duplicate column names)."""
+    if pa is None:
+        return None
+    if index:
+        data_frame = data_frame.reset_index()
+    try:
+        schema = pa.Schema.from_pandas(data_frame, preserve_index=False)
+    except (pa.ArrowException, ValueError):
+        return None
+    # the csv writer has no text form for list/struct/map values, pandas does
+    if any(pa.types.is_nested(field.type) for field in schema):
+        return None
+    return schema
+
+
+def _numeric_csv_format(data_frame):
+    """np.savetxt format for an all-integer or all-float dataframe, None for any
+    other frame, including floats holding NaN which redshift needs as empty fields."""
+    dtypes = data_frame.dtypes
+    if not len(dtypes) or not all(isinstance(dtype, np.dtype) for dtype in dtypes):
+        return None
+    kinds = {dtype.kind for dtype in dtypes}
+    if kinds == {'i'}:
+        return '%d'
+    if kinds == {'f'} and not np.isnan(data_frame.to_numpy()).any():
+        return '%.17g'
+    return None
+
+
+def _encode_csv(data_frame, index, delimiter, header=True, encoding='utf-8',
+                arrow_schema=None, numeric_fmt=None):
+    """Encode a dataframe as csv bytes, with pyarrow's C++ writer when given an
+    arrow_schema, with np.savetxt when given a numeric_fmt, otherwise with pandas."""
+    if arrow_schema is not None:
+        sink = pa.BufferOutputStream()
+        pa_csv.write_csv(_df_to_arrow_table(data_frame, index, schema=arrow_schema), sink,
+                         write_options=pa_csv.WriteOptions(include_header=header,
+                                                           delimiter=delimiter))
+        return sink.getvalue().to_pybytes()
+    if numeric_fmt is not None:
+        csv_buffer = BytesIO()
+        np.savetxt(csv_buffer, data_frame.to_numpy(), fmt=numeric_fmt, delimiter=delimiter,
+                   comments='', encoding=encoding,
+                   header=delimiter.join(str(col) for col in data_frame.columns) if header else '')
+        return csv_buffer.getvalue()
+    return data_frame.to_csv(index=index, sep=delimiter, header=header).encode(encoding)
+
+
+class _CsvChunkReader:
+    """Read-only file object that encodes a dataframe to csv one slice at a time.
+
+    boto3 pulls from read() while uploading, so encoding and the multipart
+    upload overlap and only a few encoded chunks are held in memory.
+    With compress=True the output is a gzip stream.
+    """
+
+    def __init__(self, data_frame, index, delimiter, compress=False,
+                 chunk_rows=CSV_CHUNK_ROWS, encoding='utf-8'):
+        self._data_frame = data_frame
+        self._index = index
+        self._delimiter = delimiter
+        self._chunk_rows = chunk_rows
+        self._encoding = encoding
+        # pick the encoder once for the whole frame, so every chunk of the file
+        # is formatted the same way
+        self._arrow_schema = _arrow_csv_schema(data_frame, index)
+        self._numeric_fmt = None
+        if self._arrow_schema is None and not index:
+            self._numeric_fmt = _numeric_csv_format(data_frame)
+        # wbits=31 writes a gzip header and trailer around the deflate stream
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) if compress else None
+        self._start = 0
+        self._exhausted = False
+        self._chunks = deque()
+        self._buffered = 0
+        # total bytes produced so far
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def _encode_next_chunk(self):
+        stop = self._start + self._chunk_rows
+        chunk = _encode_csv(self._data_frame.iloc[self._start:stop], self._index,
+                            self._delimiter, header=self._start == 0, encoding=self._encoding,
+                            arrow_schema=self._arrow_schema, numeric_fmt=self._numeric_fmt)
+        self._start = stop
+        self._exhausted = stop >= len(self._data_frame.index)
+        if self._compressor is not None:
+            chunk = self._compressor.compress(chunk)
+            if self._exhausted:
+                chunk += self._compressor.flush()
+        if chunk:
+            self._chunks.append(chunk)
+            self._buffered += len(chunk)
+            self.size += len(chunk)
+
+    def read(self, size=-1):
+        while not self._exhausted and (size is None or size < 0 or self._buffered < size):
+            self._encode_next_chunk()
+        if size is None or size < 0 or size >= self._buffered:
+            data = b''.join(self._chunks)
+            self._chunks.clear()
+            self._buffered = 0
+            return data
+        parts = []
+        remaining = size
+        while remaining > 0:
+            chunk = self._chunks.popleft()
+            if len(chunk) > remaining:
+                self._chunks.appendleft(chunk[remaining:])
+                chunk = chunk[:remaining]
+            parts.append(chunk)
+            remaining -= len(chunk)
+        self._buffered -= size
+        return b''.join(parts)
+
+
+def _validate_file_format(file_format):
+    if file_format not in FILE_FORMATS:
+        raise ValueError("file_format must be either 'csv' or 'parquet'")
+    if file_format == 'parquet' and pa is None:
+        raise ImportError("file_format='parquet' requires pyarrow to be installed")
+
+
+def df_to_s3(data_frame, csv_name, index, save_local, delimiter, verbose=True, file_format='csv',
+             compress=False, multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+             max_concurrency=S3_MAX_CONCURRENCY, column_data_types=None, ctx=None, **kwargs):
+    """Write a dataframe to S3, returns the size of the uploaded file in bytes
 
     Arguments:
         dataframe pd.data_frame -- data to upload
         csv_name str -- name of the file to upload
         save_local bool -- save a local copy
         delimiter str -- delimiter for csv file
+        file_format str -- 'csv' or 'parquet' (snappy compressed, delimiter is ignored)
+        compress bool -- gzip the csv file (local copy included), name it .csv.gz
+        multipart_chunksize int -- size in bytes of each part of the multipart upload
+        max_concurrency int -- number of parts uploaded in parallel
+        column_data_types list -- redshift types of the target columns, parquet numbers
+                                  are written in matching types
+        ctx RSContext -- connection to use, defaults to the one set up by connect_to_s3
     """
+    _validate_file_format(file_format)
+    ctx = _get_ctx(ctx)
+    data_frame = _to_column_major(data_frame)
     extra_kwargs = {k: v for k, v in kwargs.items(
     ) if k in S3_ACCEPTED_KWARGS and v is not None}
-    # create local backup
-    if save_local:
-        data_frame.to_csv(csv_name, index=index, sep=delimiter)
-        if verbose:
-            logger.info('saved file {0} in {1}'.format(csv_name, os.getcwd()))
-    #
-    csv_buffer = StringIO()
-    data_frame.to_csv(csv_buffer, index=index, sep=delimiter)
-    s3.Bucket(s3_bucket_var).put_object(
-        Key=s3_subdirectory_var + csv_name, Body=csv_buffer.getvalue(),
-        **extra_kwargs)
+    transfer_config = TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD,
+                                     multipart_chunksize=multipart_chunksize,
+                                     max_concurrency=max_concurrency,
+                                     use_threads=True)
+    s3_key = ctx.subdir + csv_name
+    if file_format == 'parquet':
+        table = _df_to_arrow_table(data_frame, index, column_data_types=column_data_types)
+        # create local backup
+        if save_local:
+            _write_parquet(table, csv_name)
+            if verbose:
+                logger.info('saved file {0} in {1}'.format(csv_name, os.getcwd()))
+        parquet_buffer = pa.BufferOutputStream()
+        _write_parquet(table, parquet_buffer)
+        parquet_bytes = parquet_buffer.getvalue()
+        size = parquet_bytes.size
+        ctx.s3.meta.client.upload_fileobj(Fileobj=pa.BufferReader(parquet_bytes),
+                                          Bucket=ctx.bucket, Key=s3_key,
+                                          ExtraArgs=extra_kwargs, Config=transfer_config)
+    else:
+        # create local backup
+        if save_local:
+            with open(csv_name, 'wb') as local_file:
+                shutil.copyfileobj(_CsvChunkReader(data_frame, index, delimiter, compress),
+                                   local_file)
+            if verbose:
+                logger.info('saved file {0} in {1}'.format(csv_name, os.getcwd()))
+        # stream the csv into a multipart upload while it is being encoded
+        csv_reader = _CsvChunkReader(data_frame, index, delimiter, compress)
+        ctx.s3.meta.client.upload_fileobj(Fileobj=csv_reader,
+                                          Bucket=ctx.bucket, Key=s3_key,
+                                          ExtraArgs=extra_kwargs, Config=transfer_config)
+        size = csv_reader.size
     if verbose:
         logger.info('saved file {0} in bucket {1}'.format(
-            csv_name, s3_subdirectory_var + csv_name))
+            csv_name, s3_key))
+    return size
+
+
+def _split_data_frame(data_frame, n_parts):
+    """Split data_frame into n_parts row slices of nearly equal length."""
+    bounds = np.linspace(0, len(data_frame.index), n_parts + 1).astype(int)
+    return [data_frame.iloc[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def _default_n_parts(data_frame):
+    # deep counts the strings themselves, not just the 8 byte pointers to them
+    n_parts = int(data_frame.memory_usage(deep=True).sum() // S3_PART_BYTES)
+    return max(1, min(n_parts, MAX_S3_PARTS, len(data_frame.index)))
+
+
+def df_to_s3_parts(data_frame, base_name, extension, n_parts, index, save_local, delimiter,
+                   verbose=True, file_format='csv', compress=False,
+                   max_concurrency=S3_MAX_CONCURRENCY, ctx=None, **kwargs):
+    """Upload a dataframe as n_parts files in parallel and write a redshift COPY
+    manifest listing them, returns the name of the manifest file
+
+    Arguments:
+        dataframe pd.data_frame -- data to upload
+        base_name str -- file name shared by the parts and the manifest
+        extension str -- extension of each part, e.g. '.csv.gz'
+        n_parts int -- number of files to split the data into
+        max_concurrency int -- upload threads per file, also limits how many files
+                               are uploaded at once
+        other arguments are passed on to df_to_s3
+    """
+    ctx = _get_ctx(ctx)
+    part_names = ['{0}-{1:04d}{2}'.format(base_name, i, extension) for i in range(n_parts)]
+    max_workers = max(1, min(n_parts, MAX_S3_UPLOAD_THREADS // max(1, max_concurrency)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(df_to_s3, part, part_name, index, save_local, delimiter,
+                                   verbose=verbose, file_format=file_format, compress=compress,
+                                   max_concurrency=max_concurrency, ctx=ctx, **kwargs)
+                   for part, part_name in zip(_split_data_frame(data_frame, n_parts), part_names)]
+        sizes = [future.result() for future in futures]
+
+    # content_length is required by COPY for columnar files
+    manifest = {'entries': [{'url': 's3://{0}/{1}'.format(ctx.bucket, ctx.subdir + part_name),
+                             'mandatory': True,
+                             'meta': {'content_length': size}}
+                            for part_name, size in zip(part_names, sizes)]}
+    manifest_name = base_name + '.manifest'
+    extra_kwargs = {k: v for k, v in kwargs.items(
+    ) if k in S3_ACCEPTED_KWARGS and v is not None}
+    ctx.s3.meta.client.put_object(Bucket=ctx.bucket, Key=ctx.subdir + manifest_name,
+                                  Body=json.dumps(manifest).encode('utf-8'), **extra_kwargs)
+    if verbose:
+        logger.info('saved manifest {0} in bucket {1}'.format(
+            manifest_name, ctx.subdir + manifest_name))
+    return manifest_name
+
+
+# redshift column types keyed on dtype kind, 8 byte integers are BIGINT
+_KIND_MAP = {'i': 'INTEGER', 'f': 'REAL', 'M': 'TIMESTAMP', 'b': 'BOOLEAN'}
 
 
 def pd_dtype_to_redshift_dtype(dtype):
-    if dtype.startswith('int64'):
+    """Map a dtype, or dtype name, to a redshift column type"""
+    if isinstance(dtype, str):
+        dtype = pd.api.types.pandas_dtype(dtype)
+    if dtype.kind == 'i' and dtype.itemsize == 8:
         return 'BIGINT'
-    elif dtype.startswith('int'):
-        return 'INTEGER'
-    elif dtype.startswith('float'):
-        return 'REAL'
-    elif dtype.startswith('datetime'):
-        return 'TIMESTAMP'
-    elif dtype == 'bool':
-        return 'BOOLEAN'
-    else:
-        return 'VARCHAR(MAX)'
+    return _KIND_MAP.get(dtype.kind, 'VARCHAR(MAX)')
 
 
 def get_column_data_types(data_frame, index=False, json_columns=None):
-    # [f(x) if x is not None else '' for x in xs]
-    column_data_types = [pd_dtype_to_redshift_dtype(dtype.name) if col_name not in json_columns else 'SUPER'
+    json_columns = json_columns or ()
+    column_data_types = ['SUPER' if col_name in json_columns else pd_dtype_to_redshift_dtype(dtype)
                          for dtype, col_name in zip(data_frame.dtypes.values, data_frame.columns)]
     if index:
         column_data_types.insert(
-            0, pd_dtype_to_redshift_dtype(data_frame.index.dtype.name))
+            0, pd_dtype_to_redshift_dtype(data_frame.index.dtype))
     return column_data_types
 
 
@@ -217,10 +623,12 @@ def create_redshift_table(data_frame,
                           sort_interleaved=False,
                           sortkey='',
                           json_columns=None,
-                          verbose=True):
+                          verbose=True,
+                          ctx=None):
     """Create an empty RedShift Table
 
     """
+    ctx = _get_ctx(ctx)
     if index:
         columns = list(data_frame.columns)
         if data_frame.index.name:
@@ -231,84 +639,122 @@ def create_redshift_table(data_frame,
         columns = list(data_frame.columns)
     if column_data_types is None:
         column_data_types = get_column_data_types(data_frame, index, json_columns)
-    columns_and_data_type = ', '.join(
-        ['{0} {1}'.format(x, y) for x, y in zip(columns, column_data_types)])
+    columns_and_data_type = ', '.join(f'{x} {y}' for x, y in zip(columns, column_data_types))
 
-    create_table_query = 'create table {0} ({1})'.format(
-        redshift_table_name, columns_and_data_type)
+    create_table_query = f'create table {redshift_table_name} ({columns_and_data_type})'
     if not distkey:
         # Without a distkey, we can set a diststyle
         if diststyle not in ['even', 'all']:
             raise ValueError("diststyle must be either 'even' or 'all'")
         else:
-            create_table_query += ' diststyle {0}'.format(diststyle)
+            create_table_query += f' diststyle {diststyle}'
     else:
         # otherwise, override diststyle with distkey
-        create_table_query += ' distkey({0})'.format(distkey)
+        create_table_query += f' distkey({distkey})'
     if len(sortkey) > 0:
         if sort_interleaved:
             create_table_query += ' interleaved'
-        create_table_query += ' sortkey({0})'.format(sortkey)
+        create_table_query += f' sortkey({sortkey})'
     if verbose:
         logger.info(create_table_query)
         logger.info('CREATING A TABLE IN REDSHIFT')
-    cursor.execute('drop table if exists {0};'.format(redshift_table_name))
-    cursor.execute(create_table_query)
-    connect.commit()
+    # one round trip, psycopg2 sends both statements in the open transaction
+    ctx.cursor.execute(f'drop table if exists {redshift_table_name}; {create_table_query};')
+    ctx.connect.commit()
 
 
 def s3_to_redshift(redshift_table_name, csv_name, rs_iam_role, delimiter=',', quotechar='"',
-                   dateformat='auto', timeformat='auto', region='', parameters='', verbose=True):
-    bucket_name = 's3://{0}/{1}'.format(
-        s3_bucket_var, s3_subdirectory_var + csv_name)
+                   dateformat='auto', timeformat='auto', region='', parameters='', verbose=True,
+                   file_format='csv', compress=False, manifest=False, ctx=None):
+    _validate_file_format(file_format)
+    ctx = _get_ctx(ctx)
+    bucket_name = f's3://{ctx.bucket}/{ctx.subdir}{csv_name}'
 
     if rs_iam_role:  # IAM role for the redhsift cluter to access S3 bucket
-        authorization = """
-        iam_role '{0}'
-        """.format(rs_iam_role)
+        authorization = f"""
+        iam_role '{rs_iam_role}'
+        """
     else:
-        if aws_1 and aws_2:
-            authorization = """
-        access_key_id '{0}'
-        secret_access_key '{1}'
-        """.format(aws_1, aws_2)
-        elif aws_role:  # IAM role for the user account to access S3 bucket
-            authorization = """
-        iam_role '{0}'
-        """.format(aws_role)
+        if ctx.aws_key and ctx.aws_secret:
+            authorization = f"""
+        access_key_id '{ctx.aws_key}'
+        secret_access_key '{ctx.aws_secret}'
+        """
+        elif ctx.aws_role:  # IAM role for the user account to access S3 bucket
+            authorization = f"""
+        iam_role '{ctx.aws_role}'
+        """
         else:
             authorization = ""
 
-    s3_to_sql = """
-       copy {0}
-       from '{1}'
-       delimiter '{2}'
+    manifest_option = 'manifest' if manifest else ''
+    if file_format == 'parquet':
+        # columnar copy takes its types from the file, no csv options apply
+        copy_options = f"""
+       {authorization}
+       format as parquet"""
+    else:
+        gzip_option = 'gzip' if compress else ''
+        copy_options = f"""
+       delimiter '{delimiter}'
        ignoreheader 1
-       csv quote as '{3}'
-       dateformat '{4}'
-       timeformat '{5}'
-       {6}
-       {7}
-       """.format(redshift_table_name, bucket_name, delimiter, quotechar, dateformat,
-                  timeformat, authorization, parameters)
-    logger.info(f"Copy sql:{s3_to_sql}")
-    if region:
-        s3_to_sql = s3_to_sql + "region '{0}'".format(region)
-    if aws_token != '':
-        s3_to_sql = s3_to_sql + "\n\tsession_token '{0}'".format(aws_token)
-    s3_to_sql = s3_to_sql + ';'
+       csv quote as '{quotechar}'
+       {gzip_option}
+       dateformat '{dateformat}'
+       timeformat '{timeformat}'
+       {authorization}"""
+    region_option = f"region '{region}'" if region else ''
+    token_option = f"\n\tsession_token '{ctx.aws_token}'" if ctx.aws_token != '' else ''
+    s3_to_sql = f"""
+       copy {redshift_table_name}
+       from '{bucket_name}'
+       {manifest_option}{copy_options}
+       {parameters}
+       {region_option}{token_option};"""
     if verbose:
         logger.info(mask_aws_credentials(s3_to_sql))
         # send the file
         logger.info('FILLING THE TABLE IN REDSHIFT')
     try:
-        cursor.execute(s3_to_sql)
-        connect.commit()
+        ctx.cursor.execute(s3_to_sql)
+        ctx.connect.commit()
     except Exception as e:
         print(f"Error during execution of query {s3_to_sql}: {e}")
         logger.error(e)
         traceback.print_exc(file=sys.stdout)
-        connect.rollback()
+        ctx.connect.rollback()
+        raise
+
+
+def df_to_redshift_insert(data_frame, redshift_table_name, index=False, json_columns=None,
+                          verbose=True, ctx=None):
+    """Insert a dataframe into an existing table with multi-row insert statements,
+    without going through S3. Meant for small frames only.
+
+    Arguments:
+        dataframe pd.data_frame -- data to insert
+        redshift_table_name str -- table to insert into
+        index bool -- insert the index as the first column
+        json_columns list -- columns holding json text, parsed into SUPER values
+    """
+    ctx = _get_ctx(ctx)
+    if index:
+        data_frame = data_frame.reset_index()
+    json_columns = json_columns or ()
+    template = '({0})'.format(', '.join('json_parse(%s)' if col in json_columns else '%s'
+                                        for col in data_frame.columns))
+    # python objects with missing values as None, so psycopg2 can adapt them
+    values = data_frame.astype(object).where(data_frame.notna(), None)
+    if verbose:
+        logger.info(f'INSERTING {len(values.index)} ROWS INTO REDSHIFT')
+    try:
+        execute_values(ctx.cursor, f'insert into {redshift_table_name} values %s',
+                       values.itertuples(index=False, name=None),
+                       template=template, page_size=INSERT_PAGE_ROWS)
+        ctx.connect.commit()
+    except Exception as e:
+        logger.error(e)
+        ctx.connect.rollback()
         raise
 
 
@@ -318,17 +764,10 @@ def _date_converter(ts):
     Expected input:
     "current_date  +  '18:00-00'::TIMETZ - interval '1 day'"""
     if 'current_date' in ts:
-        from datetime import date, timedelta
-        today = date.today()
-        interval_idx = ts.find('interval')
-        day_idx = ts.find('day')
-        # if both are present
-        if interval_idx != -1 and day_idx != -1:
-            # find the number of the days in the rest of the string, expecting the only one present
-            digit = int(''.join(filter(str.isdigit, ts[interval_idx:-1])))
-            ts = today + timedelta(days=-digit)
-        else:
-            ts = today
+        interval = _INTERVAL_RE.search(ts)
+        if interval:
+            return date.today() - timedelta(days=int(interval.group(1)))
+        return date.today()
     return ts
 
 
@@ -354,54 +793,101 @@ def pandas_to_redshift(data_frame,
                        verbose=True,
                        # explicit names for columns, which will be converted to "SUPER" format in redshift
                        json_columns=None,
+                       # 'csv' or 'parquet', parquet requires pyarrow
+                       file_format='csv',
+                       # gzip csv files before uploading them
+                       compress=True,
+                       # multipart upload part size in bytes and number of parallel part uploads
+                       multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+                       max_concurrency=S3_MAX_CONCURRENCY,
+                       # number of files the data is split into, loaded in parallel by COPY through a
+                       # manifest. None picks it from the size of the frame
+                       n_parts=None,
+                       # frames smaller than this many bytes are inserted directly, skipping S3 and the
+                       # copy options. 0, the default, always goes through S3
+                       insert_threshold=0,
+                       # RSContext to load through, defaults to the one set up by connect_to_*
+                       ctx=None,
                        **kwargs):
     # Validate column names.
     data_frame = validate_column_names(data_frame)
-    # query to grab 1 raw from data table
-    get_schema_sql = f'select * from {redshift_table_name} limit 1'
-
     schema_df = None
+    target_types = column_data_types
     if append:
-        schema_df = redshift_to_pandas(get_schema_sql)
+        table_columns = _get_table_columns(redshift_table_name, _get_ctx(ctx))
+        schema_df = _table_columns_to_frame(table_columns)
+        target_types = [data_type for _, data_type in table_columns]
 
     data_frame = invalidate_to_schema(data_frame, schema_df)
 
+    _validate_file_format(file_format)
+    # small frames skip S3 when asked to, unless a local copy of the file or
+    # copy options that an insert can't honour were asked for
+    use_insert = (insert_threshold > 0 and not save_local and parameters == ''
+                  and dateformat == 'auto' and timeformat == 'auto')
+    if use_insert and data_frame.memory_usage(index=index, deep=True).sum() < insert_threshold:
+        if not append:
+            create_redshift_table(data_frame, redshift_table_name,
+                                  column_data_types, index, append,
+                                  diststyle, distkey, sort_interleaved, sortkey, json_columns, verbose=verbose,
+                                  ctx=ctx)
+        df_to_redshift_insert(data_frame, redshift_table_name, index, json_columns,
+                              verbose=verbose, ctx=ctx)
+        return
+
     # Send data to S3
     # csv_name = '{}-{}.csv'.format(redshift_table_name, uuid.uuid4())
-    csv_name = '{}-{}_{}.csv'.format(redshift_table_name, _date_converter(ts_start),
-                                     _date_converter(ts_end))
+    base_name = '{}-{}_{}'.format(redshift_table_name, _date_converter(ts_start),
+                                  _date_converter(ts_end))
+    extension = '.' + file_format
+    if file_format == 'csv' and compress:
+        extension += '.gz'
+    if n_parts is None:
+        n_parts = _default_n_parts(data_frame)
+    if target_types is None:
+        # the types create_redshift_table will give the new table
+        target_types = get_column_data_types(data_frame, index, json_columns)
     s3_kwargs = {k: v for k, v in kwargs.items()
                  if k in S3_ACCEPTED_KWARGS and v is not None}
-    df_to_s3(data_frame, csv_name, index, save_local, delimiter, verbose=verbose, **s3_kwargs)
+    if n_parts > 1:
+        csv_name = df_to_s3_parts(data_frame, base_name, extension, n_parts, index, save_local,
+                                  delimiter, verbose=verbose, file_format=file_format,
+                                  compress=compress, multipart_chunksize=multipart_chunksize,
+                                  max_concurrency=max_concurrency, column_data_types=target_types,
+                                  ctx=ctx, **s3_kwargs)
+    else:
+        csv_name = base_name + extension
+        df_to_s3(data_frame, csv_name, index, save_local, delimiter, verbose=verbose,
+                 file_format=file_format, compress=compress,
+                 multipart_chunksize=multipart_chunksize, max_concurrency=max_concurrency,
+                 column_data_types=target_types, ctx=ctx, **s3_kwargs)
 
     # CREATE AN EMPTY TABLE IN REDSHIFT
     if not append:
         create_redshift_table(data_frame, redshift_table_name,
                               column_data_types, index, append,
-                              diststyle, distkey, sort_interleaved, sortkey, json_columns, verbose=verbose)
+                              diststyle, distkey, sort_interleaved, sortkey, json_columns, verbose=verbose,
+                              ctx=ctx)
 
     # CREATE THE COPY STATEMENT TO SEND FROM S3 TO THE TABLE IN REDSHIFT
     s3_to_redshift(redshift_table_name, csv_name, rs_iam_role, delimiter, quotechar,
-                   dateformat, timeformat, region, parameters, verbose=verbose)
+                   dateformat, timeformat, region, parameters, verbose=verbose,
+                   file_format=file_format, compress=compress, manifest=n_parts > 1, ctx=ctx)
 
 
-def exec_commit(sql_query):
-    cursor.execute(sql_query)
-    connect.commit()
+def exec_commit(sql_query, ctx=None):
+    ctx = _get_ctx(ctx)
+    ctx.cursor.execute(sql_query)
+    ctx.connect.commit()
 
 
-def close_up_shop():
-    global connect, cursor, s3, s3_bucket_var, s3_subdirectory_var, aws_1, aws_2, aws_token
-    cursor.close()
-    connect.commit()
-    connect.close()
-    try:
-        del connect, cursor
-    except:
-        pass
-    try:
-        del s3, s3_bucket_var, s3_subdirectory_var, aws_1, aws_2, aws_token
-    except:
-        pass
+def close_up_shop(ctx=None):
+    ctx = _get_ctx(ctx)
+    ctx.cursor.close()
+    ctx.connect.commit()
+    ctx.connect.close()
+    # forget the connection and credentials
+    for field in fields(RSContext):
+        setattr(ctx, field.name, field.default)
 
 # -------------------------------------------------------------------------------
@@ -8,9 +8,11 @@ setup(
     author='Aidan Gawronski',
     author_email='aidangawronski@gmail.com',
     # url = 'https://github.com/agawronski/pandas_redshift',
-    python_requires='>=3',
+    python_requires='>=3.7',
     install_requires=['psycopg2-binary',
+                      'numpy',
                       'pandas',
                       'boto3'],
+    extras_require={'parquet': ['pyarrow']},
     include_package_data=True
 )
@@ -0,0 +1,19 @@
+import pytest
+
+pd = pytest.importorskip('pandas')
+pytest.importorskip('pyarrow')
+pytest.importorskip('boto3')
+pytest.importorskip('psycopg2')
+
+from pandas_redshift import core  # noqa: E402
+
+
+@pytest.mark.parametrize('values', [
+    [[1, 2], [3], [4]],
+    [{'a': 1}, {'a': 2}, {'a': 3}],
+])
+def test_nested_columns_are_encoded_by_pandas(values):
+    data_frame = pd.DataFrame({'j': values})
+    assert core._arrow_csv_schema(data_frame, False) is None
+    csv = core._CsvChunkReader(data_frame, False, ',').read()
+    assert csv == data_frame.to_csv(index=False).encode('utf-8')